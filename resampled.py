@@ -1,7 +1,961 @@
+import inspect
+import itertools
+import math
+import os
+import pickle
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, reduce
+from multiprocessing import shared_memory
 from sys import exit
 
+# resamples generated at once when the resampled data are not returned
+_CHUNK_SIZE = 1000
+# resamples drawn from each independent random stream spawned per call, the unit of work split
+# across workers (blocks are reduced across streams): results depend on the seed and R only,
+# never on n_jobs or chunk_size
+_STREAM_SIZE = 250
+# values resampled per block with the threads backend: large enough for the NumPy kernels to
+# run long stretches without the GIL, small enough for the indices and values of a block to stay in
+# cache (about 1.5 MB)
+_THREAD_BLOCK_VALUES = 2 ** 16
+# engine='auto' resamples over (unique values, counts) when there are at most this many distinct
+# values per pooled value
+_TIE_RATIO = 0.5
+# items kept by the quantile sketch of summary mode at its top level (KLL k parameter)
+_SKETCH_K = 1000
+# sequential p-values: z of the Wilson interval deciding that the p-value is settled against alpha
+_Z_SEQUENTIAL = 3.0
+# adaptive R of estimate_ci: complete streams (batches) needed before the batch-means standard
+# error of the limits is trusted
+_MIN_CI_BATCHES = 10
+# exact='dp': decimals tried to turn the target into integers, and largest (k+1, S+1) table of
+# subset-sum counts built
+_MAX_DECIMALS = 6
+_MAX_DP_STATES = 10 ** 7
+# exact enumeration of sum-type statistics: splits produced per block by the revolving-door
+# recursion, and most splits whose differences are kept in resampled_diff
+_ENUMERATION_BLOCK = 2 ** 20
+_MAX_STORED_SPLITS = 10 ** 7
+# p-values: relative tolerance below which a resample or split ties with the observed one, its
+# statistic differing only by floating point rounding (as scipy.stats.permutation_test)
+_TIE_RTOL = 1e-12
+# bytes held per resampled value while a block is reduced: index, gathered value and group copy
+_BYTES_PER_VALUE = 24
+
+
+def _tie_threshold(observed):
+    """
+    Smallest resampled statistic counted as >= observed: tied values summed in another order
+    differ from it by rounding only.
+    """
+    return observed - _TIE_RTOL * np.maximum(1, np.abs(observed))
+
+
+def _draw_indices(rng, R, n, replace):
+    """
+    Draws all R resampling index vectors at once.
+
+    Returns an (R, n) integer matrix whose rows index the pooled data: drawn
+    with replacement for bootstrap, or permutations of range(n) otherwise.
+    """
+    if replace:
+        return rng.integers(0, n, size=(R, n))
+    return rng.permuted(np.broadcast_to(np.arange(n), (R, n)), axis=1)
+
+
+# bit generators selectable by name for the resampling Generator
+_BIT_GENERATORS = {'PCG64': np.random.PCG64, 'PCG64DXSM': np.random.PCG64DXSM, 'Philox': np.random.Philox,
+                   'SFC64': np.random.SFC64, 'MT19937': np.random.MT19937}
+
+
+def _make_rng(random_state=None, bit_generator=None):
+    """
+    numpy Generator from random_state (None, int, SeedSequence, BitGenerator or Generator), built on
+    bit_generator (a name in _BIT_GENERATORS or a BitGenerator class, PCG64 by default).
+    """
+    if isinstance(random_state, np.random.Generator):
+        if bit_generator is not None:
+            exit('bit_generator cannot be chosen when random_state is already a Generator')
+        return random_state
+    if isinstance(random_state, np.random.BitGenerator):
+        if bit_generator is not None:
+            exit('bit_generator cannot be chosen when random_state is already a BitGenerator')
+        return np.random.Generator(random_state)
+    if bit_generator is None:
+        bit_generator = np.random.PCG64
+    elif isinstance(bit_generator, str):
+        if bit_generator not in _BIT_GENERATORS:
+            exit("Unknown bit_generator '%s', accepted names are %s" % (bit_generator, sorted(_BIT_GENERATORS)))
+        bit_generator = _BIT_GENERATORS[bit_generator]
+    if not isinstance(random_state, np.random.SeedSequence):
+        random_state = np.random.SeedSequence(random_state)
+    return np.random.Generator(bit_generator(random_state))
+
+
+def _chunk_rows(n, chunk_size=None, max_memory=None, default=_CHUNK_SIZE):
+    """
+    Number of resamples of n values generated per block: chunk_size, or as many as fit in
+    max_memory bytes, or default when neither is set.
+    """
+    if chunk_size is not None and max_memory is not None:
+        exit('Please set either chunk_size or max_memory, not both')
+    if chunk_size is not None:
+        return max(1, int(chunk_size))
+    if max_memory is not None:
+        return max(1, int(max_memory) // (_BYTES_PER_VALUE * max(n, 1)))
+    return default
+
+
+def _index_blocks(rng, R, n, replace, chunk_size):
+    """
+    Yields the R resampling index vectors in consecutive (<=chunk_size, n) blocks. The blocks
+    consume the generator in the same order as a single _draw_indices call would.
+    """
+    for start in range(0, R, chunk_size):
+        yield _draw_indices(rng, min(chunk_size, R - start), n, replace)
+
+
+def _rebuffered(blocks, rows):
+    """
+    Regroups consecutive blocks (arrays stacked along their first axis) into blocks of rows rows, the
+    last one shorter: the draws of several streams are reduced together in blocks of chunk_size, each
+    stream still drawing from its own generator.
+    """
+    pending, size = [], 0
+    for block in blocks:
+        pending.append(block)
+        size += block.shape[0]
+        while size >= rows:
+            merged = np.concatenate(pending) if len(pending) > 1 else pending[0]
+            yield merged[:rows]
+            pending, size = [merged[rows:]], size - rows
+    if size:
+        yield np.concatenate(pending)
+
+
+def axis_aware(func):
+    """
+    Decorator flagging a user statistic as able to reduce along an ``axis`` keyword, so that
+    it is evaluated once over the whole (R, n) matrix of resamples instead of once per resample. e.g.
+        @axis_aware
+        def my_func(x, axis=None):
+            return np.percentile(x, q=33.33, axis=axis)
+    """
+    func.axis_aware = True
+    return func
+
+
+def _accepts_axis(func):
+    """
+    True when func can reduce a 2-D array row-wise through an ``axis`` keyword: explicitly flagged
+    with axis_aware, or exposing an ``axis`` parameter (np.mean, np.median, np.var, np.std,
+    functools.partial(np.percentile, q=...), ...).
+    """
+    if hasattr(func, 'axis_aware'):
+        return bool(func.axis_aware)
+    try:
+        return 'axis' in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _mean_kernel(a, axis=-1):
+    """ sum based mean along axis """
+    return a.sum(axis=axis) / a.shape[axis]
+
+
+def _var_kernel(a, axis=-1):
+    """ sum based (population, ddof=0 as np.var) variance along axis, shifted by the first value for stability """
+    n = a.shape[axis]
+    d = a - np.take(a, [0], axis=axis)
+    s = d.sum(axis=axis)
+    return np.maximum((d * d).sum(axis=axis) - s * s / n, 0) / n
+
+
+def _std_kernel(a, axis=-1):
+    return np.sqrt(_var_kernel(a, axis=axis))
+
+
+def _quantile_kernel(a, q, axis=-1):
+    """ q-th quantile (0-1, linear interpolation as np.quantile) from an np.partition selection """
+    n = a.shape[axis]
+    h = q * (n - 1)
+    lo = int(np.floor(h))
+    hi = min(lo + 1, n - 1)
+    part = np.partition(a, sorted({lo, hi}), axis=axis)
+    x_lo = np.take(part, lo, axis=axis)
+    x_hi = np.take(part, hi, axis=axis)
+    return x_lo + (h - lo) * (x_hi - x_lo)
+
+
+def _median_kernel(a, axis=-1):
+    return _quantile_kernel(a, 0.5, axis=axis)
+
+
+def _trimmed_mean_kernel(a, proportiontocut, axis=-1):
+    """ mean after cutting int(proportiontocut*n) values from each end (as scipy.stats.trim_mean), from a sorted cumsum """
+    n = a.shape[axis]
+    k = int(proportiontocut * n)
+    if k >= n - k:
+        exit('trimmed_mean: proportion to cut is too big for the sample size')
+    cs = np.cumsum(np.sort(a, axis=axis), axis=axis)
+    total = np.take(cs, n - k - 1, axis=axis)
+    if k > 0:
+        total = total - np.take(cs, k - 1, axis=axis)
+    return total / (n - 2 * k)
+
+
+# statistics recognised by name or by their numpy function, routed to the kernels above
+_KERNELS = {'mean': _mean_kernel, 'sum': lambda a, axis=-1: a.sum(axis=axis), 'median': _median_kernel,
+            'var': _var_kernel, 'std': _std_kernel}
+_NUMPY_STATISTICS = {np.mean: 'mean', np.sum: 'sum', np.median: 'median', np.var: 'var', np.std: 'std'}
+_PARAM_KERNELS = {'quantile': _quantile_kernel,
+                  'percentile': lambda a, q, axis=-1: _quantile_kernel(a, q / 100, axis=axis),
+                  'trimmed_mean': _trimmed_mean_kernel}
+
+
+def _statistic_spec(func):
+    """
+    (name, parameter) of the built-in statistic func stands for, or None when func is a generic function.
+    func can be np.mean/np.sum/np.median/np.var/np.std, a name ('mean', 'sum', 'median', 'var', 'std') or a
+    (name, parameter) tuple: ('quantile', 0.33), ('percentile', 33.33), ('trimmed_mean', 0.1).
+    """
+    if isinstance(func, str):
+        if func not in _KERNELS:
+            exit("Unknown statistic '%s', accepted names are %s" % (func, sorted(_KERNELS)))
+        return func, None
+    if isinstance(func, tuple):
+        if len(func) != 2 or func[0] not in _PARAM_KERNELS:
+            exit("Unknown statistic %s, accepted are (name, parameter) with name in %s"
+                 % (func, sorted(_PARAM_KERNELS)))
+        return func
+    try:
+        name = _NUMPY_STATISTICS.get(func)
+    except TypeError:  # unhashable callables
+        return None
+    return None if name is None else (name, None)
+
+
+def _kernel(func):
+    """
+    Returns the built-in kernel for func, kernel(a, axis), or None when func is a generic function.
+    """
+    spec = _statistic_spec(func)
+    if spec is None:
+        return None
+    name, param = spec
+    if param is None:
+        return _KERNELS[name]
+    return lambda a, axis=-1: _PARAM_KERNELS[name](a, param, axis=axis)
+
+
+def _weighted_mean(v, w, m):
+    return w @ v / m
+
+
+def _weighted_var(v, w, m):
+    """ population variance, shifted by the smallest value for stability """
+    d = v - v[0]
+    mean = w @ d / m
+    return np.maximum(w @ (d * d) / m - mean * mean, 0)
+
+
+def _weighted_quantile(v, w, m, q):
+    """ q-th quantile (linear interpolation) read from the cumulated counts """
+    h = q * (m - 1)
+    lo = int(np.floor(h))
+    hi = min(lo + 1, m - 1)
+    c = np.cumsum(w, axis=1)
+    x_lo = v[(c <= lo).sum(axis=1)]
+    x_hi = v[(c <= hi).sum(axis=1)]
+    return x_lo + (h - lo) * (x_hi - x_lo)
+
+
+def _weighted_trimmed_mean(v, w, m, proportiontocut):
+    """ trimmed mean keeping the counts between the int(proportiontocut*m) lowest and highest values """
+    k = int(proportiontocut * m)
+    if k >= m - k:
+        exit('trimmed_mean: proportion to cut is too big for the sample size')
+    kept = np.diff(np.clip(np.cumsum(w, axis=1), k, m - k), axis=1, prepend=k)
+    return kept @ v / (m - 2 * k)
+
+
+# the built-in statistics computed from (sorted values v, (B, n) counts w, sample size m)
+_WEIGHTED_KERNELS = {'mean': lambda v, w, m, _: _weighted_mean(v, w, m),
+                     'sum': lambda v, w, m, _: w @ v,
+                     'var': lambda v, w, m, _: _weighted_var(v, w, m),
+                     'std': lambda v, w, m, _: np.sqrt(_weighted_var(v, w, m)),
+                     'median': lambda v, w, m, _: _weighted_quantile(v, w, m, 0.5),
+                     'quantile': _weighted_quantile,
+                     'percentile': lambda v, w, m, q: _weighted_quantile(v, w, m, q / 100),
+                     'trimmed_mean': _weighted_trimmed_mean}
+
+
+def _weighted_kernel(func):
+    """
+    Returns kernel(v, w, m) computing func on B samples of size m given as counts w over the sorted
+    values v, or None when func has no count based kernel.
+    """
+    spec = _statistic_spec(func)
+    if spec is None:
+        return None
+    name, param = spec
+    return lambda v, w, m: _WEIGHTED_KERNELS[name](v, w, m, param)
+
+
+def _apply_statistic(func, samples, axis=-1):
+    """
+    Evaluates func on every resample of the samples array (resamples along axis) and returns the statistics.
+    Built-in kernels come first, then axis-aware functions called once on the whole array; other
+    functions fall back to one call per resample on a pandas Series.
+    """
+    kernel = _kernel(func)
+    if kernel is not None:
+        return kernel(np.asarray(samples, dtype=float), axis=axis)
+    if _accepts_axis(func):
+        return np.asarray(func(samples, axis=axis))
+    rows = np.moveaxis(samples, axis, -1)
+    stat = pd.DataFrame(rows.reshape(-1, rows.shape[-1]).T).apply(func, axis=0).to_numpy()
+    return stat.reshape(rows.shape[:-1])
+
+
+def _stream_statistics(values, groups, func, replace, streams, chunk_size, keep_samples=False):
+    """
+    Resamples the pooled values with each (rng, size) stream in turn, block by block, and reduces
+    every block to the statistic of each group (boolean masks over values). Returns the
+    (R, len(groups)) statistics and, when keep_samples is set, the (R, n) resampled values.
+    (n, k) values, k targets resampled with the same indices, give (R, len(groups), k) statistics
+    and (R, n, k) resampled values.
+    Runs in the worker processes when n_jobs > 1.
+    """
+    stats, blocks = [], []
+    draws = (idx for rng, size in streams for idx in _index_blocks(rng, size, values.shape[0], replace, chunk_size))
+    for idx in _rebuffered(draws, chunk_size):
+        samples = values[idx]
+        # contiguous copies: the kernels add the values of every row in the same order whatever
+        # the number of rows, as for the observed statistic
+        stats.append(np.stack([_apply_statistic(func, np.ascontiguousarray(samples[:, g]), axis=1)
+                               for g in groups], axis=1))
+        if keep_samples:
+            blocks.append(samples)
+    return np.concatenate(stats), np.concatenate(blocks) if keep_samples else None
+
+
+def _weighted_stream_statistics(values, groups, func, replace, streams, chunk_size, keep_samples=False):
+    """
+    Same as _stream_statistics with the counts engine: the pooled values are compressed to their
+    sorted unique values and counts, and every resample of a group of m values is a vector of
+    counts over the unique values, combined with them through matrix products instead of gathering
+    the values. Bootstrap draws the counts with Generator.multinomial, each group from its own
+    stream spawned from (rng, size); permutation splits the counts between the 2 groups with
+    Generator.multivariate_hypergeometric. The cost scales with the number of distinct values and
+    results do not depend on chunk_size. The resampled values are never materialised,
+    keep_samples is not supported.
+    """
+    v, counts = np.unique(values, return_counts=True)
+    p = counts / values.shape[0]
+    sizes = [np.arange(values.shape[0])[g].size for g in groups]
+    kernel = _weighted_kernel(func)
+
+    def draws():
+        # (rows, groups, unique values) counts
+        for rng, size in streams:
+            group_rngs = rng.spawn(len(groups))
+            for start in range(0, size, chunk_size):
+                rows = min(chunk_size, size - start)
+                if replace:
+                    yield np.stack([g_rng.multinomial(m, p, size=rows) for g_rng, m in zip(group_rngs, sizes)], axis=1)
+                else:
+                    first = group_rngs[0].multivariate_hypergeometric(counts, sizes[0], size=rows)
+                    yield np.stack([first, counts - first], axis=1)
+
+    stats = []
+    for w in _rebuffered(draws(), chunk_size):
+        stats.append(np.column_stack([kernel(v, np.ascontiguousarray(w[:, j], dtype=float), m)
+                                      for j, m in enumerate(sizes)]))
+    return np.concatenate(stats), None
+
+
+def _segmented_stream_statistics(values, groups, func, replace, streams, chunk_size, keep_samples=False):
+    """
+    Same as _stream_statistics, but every group, a contiguous segment of the values, is bootstrapped
+    on its own values only. The resamples of all the groups are drawn in the same (rows, n) index
+    blocks, each position within its segment, and 'mean' and 'sum' reduce all the segments at once
+    with np.add.reduceat. replace is always True, keep_samples is not supported.
+    """
+    positions = [np.arange(values.shape[0])[g] for g in groups]
+    sizes = np.array([p.size for p in positions])
+    low = np.repeat([p[0] for p in positions], sizes)
+    high = np.repeat(sizes, sizes)
+    # start of each segment in the concatenated resamples
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    spec = _statistic_spec(func)
+
+    def draws():
+        for rng, size in streams:
+            for start in range(0, size, chunk_size):
+                rows = min(chunk_size, size - start)
+                # floor(u * segment size) in one draw for all the segments: far faster than
+                # Generator.integers with per-column bounds
+                u = rng.random((rows, high.shape[0]))
+                u *= high
+                idx = u.astype(np.intp)
+                np.minimum(idx, high - 1, out=idx)  # u * size may round up to size
+                idx += low
+                yield idx
+
+    stats = []
+    for idx in _rebuffered(draws(), chunk_size):
+        samples = np.asarray(values[idx], dtype=float)
+        if spec in (('mean', None), ('sum', None)):
+            stat = np.add.reduceat(samples, starts, axis=1)
+            stats.append(stat / sizes if spec[0] == 'mean' else stat)
+        else:
+            stats.append(np.column_stack([_apply_statistic(func, np.ascontiguousarray(samples[:, a:a + m]), axis=1)
+                                          for a, m in zip(starts, sizes)]))
+    return np.concatenate(stats), None
+
+
+def _comb_at_most(n, k, limit):
+    """ whether C(n, k) <= limit, without computing C(n, k) in full when it is far larger """
+    k = min(k, n - k)
+    c = 1
+    for i in range(k):
+        c = c * (n - i) // (i + 1)
+        if c > limit:
+            return False
+    return c <= limit
+
+
+def _combination_blocks(n, k, chunk_size):
+    """
+    Yields every k-combination of range(n), in lexicographic order, as (<=chunk_size, k) index blocks
+    together with the (<=chunk_size, n-k) blocks of their complements.
+    """
+    combinations = itertools.combinations(range(n), k)
+    while True:
+        block = np.fromiter(itertools.chain.from_iterable(itertools.islice(combinations, chunk_size)), dtype=np.intp)
+        if block.size == 0:
+            return
+        block = block.reshape(-1, k)
+        member = np.zeros((block.shape[0], n), dtype=bool)
+        member[np.arange(block.shape[0])[:, None], block] = True
+        yield block, np.nonzero(~member)[1].reshape(-1, n - k)
+
+
+def _enumerated_statistics(values, mask1, func, chunk_size, keep_samples=False):
+    """
+    Statistic of both groups for every split of the pooled values into mask1.sum() and the
+    remaining values, i.e. the exact permutation distribution. Returns the (C, 2) statistics and,
+    when keep_samples is set, the (C, n) arrangements with the values of each split in the rows
+    of their group.
+    """
+    stats, blocks = [], []
+    for block, rest in _combination_blocks(values.shape[0], int(mask1.sum()), chunk_size):
+        stats.append(np.stack([_apply_statistic(func, values[block], axis=1),
+                               _apply_statistic(func, values[rest], axis=1)], axis=1))
+        if keep_samples:
+            samples = np.empty((block.shape[0],) + values.shape, dtype=values.dtype)
+            samples[:, mask1] = values[block]
+            samples[:, ~mask1] = values[rest]
+            blocks.append(samples)
+    return np.concatenate(stats), np.concatenate(blocks) if keep_samples else None
+
+
+def _pvalue_settled(k, m, alpha=None, mc_tol=None):
+    """
+    Sequential Monte Carlo stopping rule for a p-value estimated by k exceedances in m resamples.
+    Settled when the Wilson interval (z = _Z_SEQUENTIAL) of the p-value excludes alpha, so the
+    decision cannot change with more resamples: as in Besag-Clifford sampling, clearly null tests
+    stop after a few exceedances. Or when the Monte Carlo standard error is at most mc_tol.
+    """
+    p = k / m
+    if mc_tol is not None:
+        p_ = (k + 1) / (m + 2)  # keeps the error of an all-or-nothing start above 0
+        if np.sqrt(p_ * (1 - p_) / m) <= mc_tol:
+            return True
+    if alpha is not None:
+        z2 = _Z_SEQUENTIAL ** 2
+        center = (p + z2 / (2 * m)) / (1 + z2 / m)
+        half = _Z_SEQUENTIAL * np.sqrt(p * (1 - p) / m + z2 / (4 * m * m)) / (1 + z2 / m)
+        return center - half > alpha or center + half < alpha
+    return False
+
+
+def _maxt_adjusted(resampled_diff, observed):
+    """
+    Westfall-Young step-down max-T adjusted p-values of k targets from the same (R, k) resampled
+    differences, strong control of the family-wise error under the dependence between targets.
+    Every target is standardised by the mean and sd of its resampled (null) differences; the
+    targets are ordered by decreasing observed T, each is compared to the max over itself and the
+    less significant ones in every resample, and the p-values are made monotone in that order.
+    """
+    mu = resampled_diff.mean(axis=0)
+    sd = resampled_diff.std(axis=0)
+    sd = np.where(sd > 0, sd, 1)  # constant null distribution, e.g. a constant column
+    t_obs = (observed - mu) / sd
+    order = np.argsort(-t_obs, kind='stable')
+    t = ((resampled_diff - mu) / sd)[:, order]
+    # successive maxima from the least significant target up
+    u = np.maximum.accumulate(t[:, ::-1], axis=1)[:, ::-1]
+    adjusted = np.empty(t_obs.shape[0])
+    adjusted[order] = np.maximum.accumulate(np.mean(u >= t_obs[order], axis=0))
+    return adjusted
+
+
+def _quantile_se(stat, q):
+    """
+    Distribution-free Monte Carlo standard error of the q-th (0-1) quantile of the resampled
+    statistics: half the spread of the order statistics one binomial standard deviation,
+    sqrt(m*q*(1-q)), below and above rank m*q. One per column for (m, k) statistics.
+    """
+    m = stat.shape[0]
+    half = np.sqrt(m * q * (1 - q))
+    lo = int(max(np.floor(m * q - half), 0))
+    hi = int(min(np.ceil(m * q + half), m - 1))
+    part = np.partition(stat, sorted({lo, hi}), axis=0)
+    return (part[hi] - part[lo]) / 2
+
+
+def _batch_limits(stat, alpha_level):
+    """
+    (upper, lower) percentile limits of every complete stream of _STREAM_SIZE statistics (along
+    axis 0): a (batches, [targets,] 2) array.
+    """
+    n_batches = stat.shape[0] // _STREAM_SIZE
+    blocks = stat[:n_batches * _STREAM_SIZE].reshape((n_batches, _STREAM_SIZE) + stat.shape[1:])
+    return np.moveaxis(np.percentile(blocks, q=[100-0.5*100*alpha_level, 0.5*100*alpha_level], axis=1), 0, -1)
+
+
+def _batch_se(batches):
+    """ batch-means standard errors of the limits of every batch, std / sqrt(batches); NaN below 2 batches """
+    batches = np.asarray(batches)
+    if batches.shape[0] < 2:
+        return np.full(batches.shape[1:], np.nan)
+    return batches.std(axis=0, ddof=1) / np.sqrt(batches.shape[0])
+
+
+def _ci_se(stat, alpha_level, batches):
+    """
+    Monte Carlo standard errors of the (upper, lower) limits: the larger of the order statistics and
+    the batch-means estimates. The order statistics alone give 0 when ties span the ranks around the
+    limit (medians or means of integer data), while the limit still moves from run to run.
+    """
+    q = 0.5 * alpha_level
+    order_se = np.array([_quantile_se(stat, 1 - q), _quantile_se(stat, q)])
+    return tuple(np.fmax(order_se, np.moveaxis(_batch_se(batches), -1, 0)))
+
+
+def _ci_settled(batches, alpha_level, ci_tol):
+    """
+    Adaptive bootstrap stopping rule on the limits of the batches (complete streams) so far: the
+    batch-means standard errors of both limits, which ties do not hide, are at most ci_tol, once
+    there are _MIN_CI_BATCHES batches and at least 10 resamples are expected beyond each limit.
+    """
+    n_batches = len(batches)
+    if n_batches < _MIN_CI_BATCHES or n_batches * _STREAM_SIZE * 0.5 * alpha_level < 10:
+        return False
+    return np.max(_batch_se(batches)) <= ci_tol
+
+
+def _revolving_door_sums(v, k, chosen, block=_ENUMERATION_BLOCK):
+    """
+    Sums of all the k-subsets of v, yielded in blocks following the revolving-door (Gray code) order
+    of the combinations, in which successive subsets differ by swapping a single value. The order is
+    built from the recursion R(m, j) = R(m-1, j) then reversed R(m-1, j-1) + v[m-1], so each sum comes
+    from a sum with one value less by one addition: O(1) per split instead of O(k). The sums over the
+    first m0 values (lists of at most block sums) are tabulated once and shifted by the sum of the
+    values chosen above m0 at every leaf of the recursion.
+    Returns the sum of the subset chosen (boolean mask), computed in the same order so that it
+    compares exactly with its own entry, and the generator of blocks.
+    """
+    n = v.shape[0]
+    # table[m][j]: sums of the j-subsets of v[:m], in revolving-door order
+    table = [{0: np.zeros(1)}]
+    while len(table) <= n and math.comb(len(table), min(k, len(table) // 2)) <= block:
+        m = len(table)
+        row = {}
+        for j in range(min(m, k) + 1):
+            parts = [table[m - 1][j]] if j < m else []
+            if j >= 1:
+                parts.append(table[m - 1][j - 1][::-1] + v[m - 1])
+            row[j] = np.concatenate(parts)
+        table.append(row)
+    m0 = len(table) - 1
+
+    def descend(m, j, offset, reverse):
+        if m <= m0:
+            sums = table[m][j]
+            yield offset + (sums[::-1] if reverse else sums)
+            return
+        parts = []
+        if j < m:
+            parts.append((m - 1, j, offset, reverse))
+        if j >= 1:
+            parts.append((m - 1, j - 1, offset + v[m - 1], not reverse))
+        for part in (parts[::-1] if reverse else parts):
+            yield from descend(*part)
+
+    offset, low = 0.0, 0.0
+    for i in range(n - 1, m0 - 1, -1):
+        if chosen[i]:
+            offset = offset + v[i]
+    for i in range(m0):
+        if chosen[i]:
+            low = low + v[i]
+    return offset + low, descend(n, k, 0.0, False)
+
+
+def _enumerated_sum_differences(values, mask1, func):
+    """
+    Exact permutation distribution of the difference of the 'mean' or 'sum' statistic, from the
+    incremental subset sums of _revolving_door_sums. Returns the differences for every split (None
+    beyond _MAX_STORED_SPLITS splits, only counted), the observed difference and the exact p-value.
+    The difference grows with the sum of the lvl1 values, so the p-value counts the subset sums of the
+    integer scaled values >= the observed one, exactly, tied sums included; without an integer scale
+    the differences are compared with the relative tolerance _TIE_RTOL.
+    """
+    v = np.asarray(values, dtype=float)
+    n1 = int(mask1.sum())
+    n2 = v.shape[0] - n1
+    total = v.sum()
+    if _statistic_spec(func)[0] == 'mean':
+        difference = lambda S: S / n1 - (total - S) / n2
+    else:
+        difference = lambda S: S - (total - S)
+    s_obs, blocks = _revolving_door_sums(v, n1, mask1)
+    obs_diff = difference(s_obs)
+    n_splits = math.comb(v.shape[0], n1)
+    keep = n_splits <= _MAX_STORED_SPLITS
+    ints = _integer_scaled(v)
+    if ints is not None:
+        # integer sums (exact in float64) in the same order as the sums of the values
+        s_obs_int, int_blocks = _revolving_door_sums(ints.astype(float), n1, mask1)
+    kept, count = [], 0
+    if ints is not None and not keep:
+        for int_sums in int_blocks:
+            count += np.count_nonzero(int_sums >= s_obs_int)
+        return None, obs_diff, count / n_splits
+    threshold = _tie_threshold(obs_diff)
+    for sums in blocks:
+        diff = difference(sums)
+        if ints is not None:
+            count += np.count_nonzero(next(int_blocks) >= s_obs_int)
+        else:
+            count += np.count_nonzero(diff >= threshold)
+        if keep:
+            kept.append(diff)
+    return np.concatenate(kept) if kept else None, obs_diff, count / n_splits
+
+
+def _midranks(values):
+    """ ranks 1..n of values, tied values sharing the average of their ranks (as pandas rank), by column """
+    if values.ndim > 1:
+        return np.apply_along_axis(_midranks, 0, values)
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    return (np.cumsum(counts) - (counts - 1) / 2)[inverse.ravel()]
+
+
+def _integer_scaled(values):
+    """
+    values scaled by the smallest power of 10 (up to 10**_MAX_DECIMALS) making them integers, shifted
+    to start at 0 and divided by their gcd; None when no such scale exists.
+    """
+    for decimals in range(_MAX_DECIMALS + 1):
+        scaled = np.asarray(values, dtype=float) * 10 ** decimals
+        ints = np.round(scaled)
+        if np.allclose(scaled, ints, rtol=0, atol=1e-6):
+            ints = (ints - ints.min()).astype(np.int64)
+            return ints // max(np.gcd.reduce(ints), 1)
+    return None
+
+
+def _subset_sum_pvalue(values, mask1):
+    """
+    Exact permutation p-value P(S >= s_obs) of the sum S of mask1.sum() values drawn without
+    replacement from values, s_obs being the sum of values[mask1]. The distribution of S is counted
+    by dynamic programming over the integer scaled values: dp[j, s] is the number of j-subsets of
+    the values seen so far summing to s, O(n * k * S). None when the values cannot be integer scaled
+    or the table would exceed _MAX_DP_STATES.
+    """
+    ints = _integer_scaled(values)
+    if ints is None:
+        return None
+    k = int(mask1.sum())
+    top = int(np.sort(ints)[::-1][:k].sum())
+    if (k + 1) * (top + 1) > _MAX_DP_STATES:
+        return None
+    # float counts: the number of subsets can overflow int64 while p-values need relative precision only
+    dp = np.zeros((k + 1, top + 1))
+    dp[0, 0] = 1
+    for v in ints:
+        if v <= top:
+            dp[1:, v:] += dp[:-1, :top + 1 - v]
+    s_obs = int(ints[mask1].sum())
+    return dp[k, s_obs:].sum() / dp[k].sum()
+
+
+class ResampledSummary():
+    """
+    Constant memory summary of resampled statistics, returned in place of resampled_diff and
+    bootstrapped_stat with summary=True: the number of resamples, a running counter of the values
+    >= observed (the p-value numerator), min/max/mean and a mergeable KLL quantile sketch.
+    Summaries of different chunks, e.g. from parallel workers, combine with merge.
+    """
+
+    def __init__(self, observed=None, k=_SKETCH_K):
+        self.observed = observed
+        self.k = k
+        self.n = 0
+        self.exceedances = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sum = 0.0
+        self.levels = [np.empty(0)]  # level h holds items of weight 2**h
+        self._compactions = 0
+
+    def update(self, values):
+        """ adds a batch of resampled statistics """
+        values = np.asarray(values, dtype=float)
+        if values.size == 0:
+            return self
+        self.n += values.size
+        if self.observed is not None:
+            self.exceedances += np.count_nonzero(values >= _tie_threshold(self.observed))
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.sum += values.sum()
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """ adds the resamples summarised by other (same observed value) to this summary """
+        self.n += other.n
+        self.exceedances += other.exceedances
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sum += other.sum
+        for h, items in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self._compress()
+        return self
+
+    def _capacity(self, h):
+        return max(int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - h - 1))), 2)
+
+    def _compress(self):
+        """ compacts full levels: every other sorted item moves up one level with twice the weight """
+        h = 0
+        while h < len(self.levels):
+            if self.levels[h].size <= self._capacity(h):
+                h += 1
+                continue
+            if h + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            items = np.sort(self.levels[h])
+            keep = items[-1:] if items.size % 2 else items[:0]
+            items = items[:items.size - keep.size]
+            # alternate the kept half between compactions to stay unbiased without randomness
+            self._compactions += 1
+            self.levels[h + 1] = np.concatenate([self.levels[h + 1], items[self._compactions % 2::2]])
+            self.levels[h] = keep
+            h = 0
+
+    @property
+    def pval(self):
+        return self.exceedances / self.n
+
+    @property
+    def mean(self):
+        return self.sum / self.n
+
+    def quantile(self, q):
+        """ approximate q-th (0-1) quantile(s) of the summarised statistics """
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(level.size, 2.0 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(items)
+        cum = np.cumsum(weights[order])
+        # rank of each sorted item at the middle of its weight, interpolated linearly as np.quantile
+        ranks = (cum - weights[order] / 2) / cum[-1]
+        return np.interp(q, ranks, items[order])
+
+    def __repr__(self):
+        return 'ResampledSummary(n=%d, exceedances=%d, mean=%.6g)' % (self.n, self.exceedances, self.mean)
+
+
+def _push_summary(stack, block):
+    """
+    Pushes the (height, index, summary) block, the summary of streams index*2**height to
+    (index+1)*2**height, on the stack of consecutive blocks and merges it with its sibling while
+    there is one: the summaries are merged along the same binary tree over the streams whatever
+    contiguous runs of streams the workers summarised, so the sketch depends on the streams only.
+    """
+    stack.append(block)
+    while len(stack) > 1 and stack[-2][0] == stack[-1][0] and stack[-2][1] % 2 == 0 and \
+            stack[-2][1] + 1 == stack[-1][1]:
+        (h, i, left), (_, _, right) = stack[-2], stack.pop()
+        stack[-1] = (h + 1, i // 2, left.merge(right))
+    return stack
+
+
+def _summarized_statistics(worker, summary, contrast, values, groups, func, replace, streams, chunk_size,
+                           keep_samples=False):
+    """
+    Runs worker stream by stream and reduces the resampled statistics of every stream, combined
+    across groups by contrast ([1, -1] for a difference, [1] for a single group), into a copy of
+    the empty summary. Returns the stack of merged blocks of _push_summary.
+    """
+    stack = []
+    for i, stream in zip(range(streams.start, streams.stop), streams):
+        stats, _ = worker(values, groups, func, replace, [stream], chunk_size)
+        _push_summary(stack, (0, i, ResampledSummary(summary.observed, summary.k).update(stats @ contrast)))
+    return stack, None
+
+
+def _combine(parts):
+    """ concatenates per-task statistics, or pushes the blocks of per-task summary stacks in order """
+    if isinstance(parts[0], list):
+        stack = []
+        for block in itertools.chain.from_iterable(parts):
+            _push_summary(stack, block)
+        return stack
+    return np.concatenate(parts)
+
+
+class _Streams():
+    """
+    The random streams of one call, as a lazy sequence of (Generator, size) pairs: stream i resamples
+    up to _STREAM_SIZE of the R resamples from the i-th child of seed (a SeedSequence), built only
+    when iterated, so that memory does not grow with R. Slices are _Streams too, cheap to send to
+    the workers.
+    """
+
+    def __init__(self, seed, bit_generator, R, start=0, stop=None):
+        self.seed = seed
+        self.bit_generator = bit_generator
+        self.R = R
+        self.start = start
+        self.stop = -(-R // _STREAM_SIZE) if stop is None else stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        """ contiguous slice of the streams """
+        start, stop, _ = index.indices(len(self))
+        return _Streams(self.seed, self.bit_generator, self.R, self.start + start, self.start + max(stop, start))
+
+    def sizes(self):
+        """ number of resamples of every stream """
+        return [min(_STREAM_SIZE, self.R - i * _STREAM_SIZE) for i in range(self.start, self.stop)]
+
+    def __iter__(self):
+        for i, size in zip(range(self.start, self.stop), self.sizes()):
+            child = np.random.SeedSequence(self.seed.entropy, spawn_key=self.seed.spawn_key + (i,),
+                                           pool_size=self.seed.pool_size)
+            yield np.random.Generator(self.bit_generator(child)), size
+
+
+def _init_worker():
+    """
+    Initializer of the worker processes: importing this module loads NumPy and pandas at start
+    up, the first resamples warm them up before any task arrives.
+    """
+    _apply_statistic(np.mean, _draw_indices(np.random.default_rng(), 2, 2, replace=True), axis=1)
+
+
+def _picklable(obj):
+    """ True if obj can be sent to worker processes """
+    try:
+        pickle.dumps(obj)
+    except Exception:
+        return False
+    return True
+
+
+def _share_arrays(*arrays):
+    """
+    Copies the arrays once into a single shared memory block for the worker processes.
+    Returns the SharedMemory, to close and unlink by the caller, and the (offset, shape, dtype)
+    specs of the arrays inside it for _shared_stream_statistics.
+    """
+    specs, offset = [], 0
+    for a in arrays:
+        specs.append((offset, a.shape, a.dtype.str))
+        offset += -(-a.nbytes // 8) * 8  # keep every array 8 bytes aligned
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for a, (start, shape, dtype) in zip(arrays, specs):
+        np.ndarray(shape, dtype, buffer=shm.buf, offset=start)[...] = a
+    return shm, specs
+
+
+def _shared_stream_statistics(worker, name, specs, func, replace, streams, chunk_size, keep_samples=False):
+    """
+    worker (_stream_statistics or _weighted_stream_statistics) on pooled values and group masks
+    attached zero-copy from the shared memory block created by _share_arrays. The resampled
+    values, with keep_samples, are copies and outlive the block.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        values, masks = [np.ndarray(shape, dtype, buffer=shm.buf, offset=start) for start, shape, dtype in specs]
+        stats, samples = worker(values, list(masks), func, replace, streams, chunk_size, keep_samples)
+        del values, masks  # release the views before closing the block
+    finally:
+        shm.close()
+    return stats, samples
+
+
+class PreparedData():
+    """
+    Target values of a dataframe grouped by level, built once by Resample.prepare and passed to
+    run_hypothesis and estimate_ci in place of the dataframe: the levels column is factorized
+    (sorted, missing levels dropped) and the values stably sorted by level code, so the values of
+    each level are a contiguous slice, found without scanning the dataframe again.
+    """
+
+    def __init__(self, df, target, levels):
+        codes, uniques = pd.factorize(df[levels], sort=True)
+        order = np.argsort(codes, kind='stable')
+        order = order[codes[order] >= 0]
+        self.target = target
+        self.levels = levels
+        self.uniques = np.asarray(uniques)
+        self.codes = codes[order]
+        self.values = df[target].to_numpy()[order]
+        # values[bounds[i]:bounds[i+1]] are the values of level uniques[i]
+        self.bounds = np.searchsorted(self.codes, np.arange(len(self.uniques) + 1))
+        self._slices = {level: slice(start, stop)
+                        for level, start, stop in zip(self.uniques, self.bounds[:-1], self.bounds[1:])}
+
+    def __getitem__(self, level):
+        """ values of level (a view), empty for an absent level """
+        return self.values[self._slices.get(level, slice(0, 0))]
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __repr__(self):
+        return 'PreparedData(target=%r, levels=%r, n=%d, n_levels=%d)' % (self.target, self.levels, len(self),
+                                                                           len(self.uniques))
+
+
+def _level_values(df, target, levels, lvl):
+    """
+    Target values at level lvl of a dataframe, or of a PreparedData (target and levels None or the
+    prepared ones).
+    """
+    if isinstance(df, PreparedData):
+        if (target is not None and target != df.target) or (levels is not None and levels != df.levels):
+            exit('target and levels must be None or match the prepared ones')
+        return df[lvl]
+    return df[target].to_numpy()[df[levels].to_numpy() == lvl]
+
+
 class Resample():
     """
         There are 2 methods in the class:
@@ -20,26 +974,249 @@ class Resample():
 
         """
 
-    def __init__(self, resampling_method):
+    def __init__(self, resampling_method, random_state=None, bit_generator=None, n_jobs=1, backend='processes',
+                 keep_pool=False):
         """
         Parameters
         ----------
         resampling method : str
              Initiates the class with the hypothesis testing is targeted. Accepted values are
              'bootstrap' and 'permutation'.
+        random_state : None/int/numpy SeedSequence/BitGenerator/Generator
+             Seed or source of the random numbers used to resample. Two instances created with the same int or
+             SeedSequence produce the same results. The default None seeds from fresh OS entropy.
+        bit_generator : str or numpy BitGenerator class
+             Bit generator of the resampling Generator: 'PCG64' (default), 'PCG64DXSM', 'Philox', 'SFC64'
+             or 'MT19937'. Not used when random_state is already a Generator or BitGenerator.
+        n_jobs : int
+             Number of worker processes sharing the R resamples, -1 for all the CPUs. The default is 1.
+             Every call spawns independent random streams of 250 resamples from random_state, so
+             results are identical whatever n_jobs. With return_resampled the workers also send back their
+             resampled values, pickled from worker processes. With worker processes a func that cannot be
+             pickled (lambda, local function) runs in the calling process instead.
+        backend : str
+             'processes' (default) or 'threads'. Threads skip the process start up and data pickling and
+             suit built-in or NumPy statistics, which release the GIL; pure Python statistics still
+             run one at a time.
+        keep_pool : bool
+             Keep the worker pool alive across run_hypothesis and estimate_ci calls until close() is called.
+             The default False starts a pool per call. Used as a context manager the instance keeps its pool
+             for the with block:
+                 with Resample('permutation', n_jobs=4) as rs:
+                     rs.run_hypothesis(...)
         """
         if resampling_method != 'bootstrap' and resampling_method != 'permutation':
             exit("Please set resampling method as 'bootstrap' or 'permutation' ")
         self.method = resampling_method
+        self.rng = _make_rng(random_state, bit_generator)
+        if n_jobs == -1:
+            n_jobs = os.cpu_count() or 1
+        if not isinstance(n_jobs, int) or n_jobs < 1:
+            exit('Please set n_jobs as a positive integer or -1')
+        self.n_jobs = n_jobs
+        if backend != 'processes' and backend != 'threads':
+            exit("Please set backend as 'processes' or 'threads' ")
+        self.backend = backend
+        self.keep_pool = keep_pool
+        self._pool = None
+
+    def _block_rows(self, n):
+        """
+        Default number of resamples of n values per block: large GIL-free blocks for threads.
+        """
+        if self.backend == 'threads':
+            return max(_THREAD_BLOCK_VALUES // max(n, 1), 1)
+        return _CHUNK_SIZE
+
+    def _resampled_statistics(self, values, groups, func, replace, R, chunk_size, keep_samples=False,
+                              engine='index', stop=None, summary=None, contrast=None):
+        """
+        Per-resample statistic of each group for R resamples of values, see _stream_statistics
+        (engine 'index'), _weighted_stream_statistics (engine 'weights') and
+        _segmented_stream_statistics (engine 'segments', each group bootstrapped on its own).
+        R is split into streams (_Streams) derived from one seed spawned from self.rng per call,
+        shared in contiguous runs among n_jobs worker processes (or threads) which send back the
+        statistics, and the resampled values with keep_samples. Worker processes read the values
+        from shared memory.
+        With stop, a callable taking the statistics of one more stream and keeping its own running
+        state (e.g. an exceedance count), the streams run in waves of n_jobs and stop is called on
+        every stream in order: the resamples end with the first stream for which it returns True,
+        so the result does not depend on n_jobs either. Each statistic is seen by stop once.
+        With summary, an empty ResampledSummary, the statistics combined by contrast are reduced
+        into a summary per stream as they are produced (by each worker), merged along a fixed tree
+        over the streams (_push_summary) so that the sketch does not depend on n_jobs either.
+        """
+        # one child seed per call, the streams derive from it lazily
+        streams = _Streams(self.rng.bit_generator.seed_seq.spawn(1)[0], type(self.rng.bit_generator), R)
+        worker = {'weights': _weighted_stream_statistics,
+                  'segments': _segmented_stream_statistics}.get(engine, _stream_statistics)
+        if summary is not None:
+            worker = partial(_summarized_statistics, worker, summary, np.asarray(contrast, dtype=float))
+        wave = len(streams) if stop is None else self.n_jobs
+        # a func that cannot be pickled (lambda, local function) runs in this process, with the same results
+        serial = self.n_jobs == 1 or (self.backend == 'processes' and not _picklable(func))
+        stats, samples = [], []
+        try:
+            for start in range(0, len(streams), wave):
+                stat, sample = self._run_streams(worker, values, groups, func, replace, streams[start:start + wave],
+                                                 chunk_size, keep_samples, serial)
+                stats.append(stat)
+                samples.append(sample)
+                if stop is None:
+                    continue
+                # feed the streams of the wave to stop in order, up to the first settled one
+                end = 0
+                for size in streams[start:start + wave].sizes():
+                    end += size
+                    if stop(stat[end - size:end]):
+                        break
+                else:
+                    continue
+                stats[-1] = stat[:end]
+                samples[-1] = sample[:end] if keep_samples else None
+                break
+        except BaseException:
+            # the pool is dropped without waiting for workers still busy with the failed call
+            self.close(wait=False)
+            raise
+        if not self.keep_pool:
+            self.close()
+        if summary is not None:
+            # the incomplete subtrees left at the end, merged in stream order
+            blocks = [block for _, _, block in _combine(stats)]
+            return reduce(ResampledSummary.merge, blocks), None
+        return _combine(stats), np.concatenate(samples) if keep_samples else None
+
+    def _run_streams(self, worker, values, groups, func, replace, streams, chunk_size, keep_samples, serial):
+        """
+        Runs worker on the streams, in this process (serial) or split among the n_jobs workers of the pool.
+        """
+        n_jobs = min(self.n_jobs, len(streams))
+        if n_jobs == 1 or serial:
+            return worker(values, groups, func, replace, streams, chunk_size, keep_samples)
+
+        bounds = [len(streams) * j // n_jobs for j in range(n_jobs + 1)]
+        tasks = [streams[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+        shm = None
+        if self.backend == 'threads' or values.dtype.hasobject:
+            job = partial(worker, values, groups)
+        else:
+            # worker processes attach to the (numeric) pooled values and the group masks in shared
+            # memory instead of receiving a pickled copy each
+            masks = np.zeros((len(groups), values.shape[0]), dtype=bool)
+            for mask, group in zip(masks, groups):
+                mask[group] = True
+            shm, specs = _share_arrays(values, masks)
+            job = partial(_shared_stream_statistics, worker, shm.name, specs)
+
+        pool = self._executor()
+        futures = []
+        try:
+            futures = [pool.submit(job, func, replace, task, chunk_size, keep_samples) for task in tasks]
+            results = [future.result() for future in futures]
+        except BaseException:
+            # errors and KeyboardInterrupt: drop the pending work before releasing the shared block
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        stats, samples = zip(*results)
+        return _combine(stats), np.concatenate(samples) if keep_samples else None
+
+    @staticmethod
+    def _resolve_engine(engine, func, values, replace, keep_samples):
+        """
+        Resampling engine to run func with: 'index' or 'weights'. 'auto' picks the counts engine for
+        built-in statistics on low-cardinality targets; exits when the requested engine cannot run.
+        """
+        if engine == 'auto':
+            if keep_samples or _weighted_kernel(func) is None or values.ndim > 1:
+                return 'index'
+            n_unique = np.unique(values).shape[0]
+            return 'weights' if n_unique <= _TIE_RATIO * values.shape[0] else 'index'
+        if engine == 'index':
+            return engine
+        if engine != 'weights':
+            exit("Please set engine as 'auto', 'index' or 'weights' ")
+        if keep_samples:
+            exit("engine='weights' does not build resampled_, please set return_resampled=False")
+        if values.ndim > 1:
+            exit("engine='weights' supports a single target only")
+        if _weighted_kernel(func) is None:
+            exit("engine='weights' supports only the built-in statistics 'mean', 'sum', 'var', 'std', 'median', "
+                 "('quantile', q), ('percentile', q) and ('trimmed_mean', p)")
+        return engine
+
+    def _executor(self):
+        """
+        Worker pool of the instance, started on first use with workers that pre-import NumPy and pandas.
+        """
+        if self._pool is None:
+            if self.backend == 'threads':
+                self._pool = ThreadPoolExecutor(max_workers=self.n_jobs)
+            else:
+                self._pool = ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker)
+        return self._pool
 
-    def run_hypothesis(self, df, target, levels, lvl1, lvl2, R, func):
+    def close(self, wait=True):
         """
+        Shuts down the worker pool, if any. Pending work is cancelled; with wait=False the running
+        work is not waited for.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait, cancel_futures=True)
+            self._pool = None
+
+    def __enter__(self):
+        self._keep_pool_outside, self.keep_pool = self.keep_pool, True
+        return self
+
+    def __exit__(self, *exc):
+        self.keep_pool = self._keep_pool_outside
+        self.close()
+
+    @staticmethod
+    def prepare(df, target, levels):
+        """
+        Groups the target by level once for repeated calls on the same dataframe, e.g. many level pairs:
+            data = Resample.prepare(df, 'target_feature', 'levels_feature')
+            rs.run_hypothesis(data, None, None, level_1, level_2, R=10000, func=np.mean)
+            rs.estimate_ci(data, None, None, level_1, R=10000, func=np.mean)
+
         Parameters
         ----------
         df : PANDAS dataframe
             Entire dataset.
         target : str
-            Feature/column name that contains the data 
+            Feature/column name that contains the data.
+        levels : str
+            Feature/column name describing the categories in which the measurements are divided.
+
+        Returns
+        -------
+        data: PreparedData
+            Values of every level as a contiguous NumPy slice, accepted by run_hypothesis and estimate_ci
+            in place of df.
+        """
+        return PreparedData(df, target, levels)
+
+    def run_hypothesis(self, df, target, levels, lvl1, lvl2, R, func, return_resampled=True,
+                       chunk_size=None, max_memory=None, engine='auto', exact='auto', ranks=False,
+                       alpha=None, mc_tol=None, summary=False, adjust=None):
+        """
+        Parameters
+        ----------
+        df : PANDAS dataframe or PreparedData
+            Entire dataset, or the dataset grouped by level with Resample.prepare (target and levels are then
+            None or the prepared ones).
+        target : str or list
+            Feature/column name that contains the data. A list of columns tests all of them with the same
+            resamples (Monte Carlo or enumerated, built-in 'index' engine): the statistic of every column is
+            evaluated on the (R, n, k) block of resampled values, not with summary=True. With alpha or mc_tol
+            the resampling stops once every column is settled.
         levels : str
             Feature/column name describing the categories in which the 
             measurements are divided.            
@@ -56,66 +1233,324 @@ class Resample():
             run_hypothesis(df,'target_feature','levels_feature',level_1,level_2,R=10000,func=my_func)
         OR:
             run_hypothesis(df,'target_feature','levels_feature',level_1,level_2,R=10000,func=np.mean)
+            Functions accepting an ``axis`` keyword (np.mean, np.median, np.var, ...) or decorated
+            with @axis_aware are evaluated once over all the resamples instead of once per resample.
+            np.mean, np.sum, np.median, np.var, np.std and the named statistics 'mean', 'sum', 'median', 'var',
+            'std', ('quantile', q), ('percentile', q), ('trimmed_mean', proportiontocut) use built-in fast kernels,
+            e.g.
+            run_hypothesis(df,'target_feature','levels_feature',level_1,level_2,R=10000,func=('quantile', 0.33))
+        return_resampled : bool
+            Build and return the resampled_ dataframe. The default is True. With False resampled_ is None and
+            the resamples are generated and reduced in blocks, so memory grows with R only, not n*R.
+        chunk_size : int, optional
+            Number of resamples generated and reduced per block, a block spanning several random streams.
+            The default is R when return_resampled is True, otherwise 1000, or about 64k values (2**16 // n
+            resamples of n values) with the threads backend. Results do not depend on the block size.
+        max_memory : int, optional
+            Memory budget in bytes for a block of resamples, used to derive chunk_size instead.
+        engine : str
+            'index' gathers the resampled values through index matrices. 'weights' (with return_resampled=False)
+            compresses the target to its unique values and counts and draws every resample as counts,
+            multinomial for bootstrap or hypergeometric for permutation, then computes the statistic by
+            matrix products. It supports the built-in 'mean', 'sum', 'var', 'std', 'median', ('quantile', q),
+            ('percentile', q) and ('trimmed_mean', p) statistics. The default 'auto' uses 'weights' when
+            it applies and the target has at most n/2 distinct values (heavy ties), 'index' otherwise.
+            Both engines give the same distribution, but not the same resamples: seeded results depend
+            on the engine picked, set engine='index' to reproduce results of the index engine.
+        exact : 'auto'/bool/'dp'
+            Permutation only: enumerate all the C(n1+n2, n1) splits of the 2 levels instead of drawing R random
+            permutations, giving the exact p-value. The default 'auto' enumerates when there are no more
+            splits than R, True always enumerates, False always draws R permutations.
+            For 'mean' and 'sum' with return_resampled=False the splits are enumerated in Gray code order, each
+            split updating the previous sum by one swap, which keeps exact tests feasible for about 15 values
+            per level; resampled_diff is None past 1e7 splits.
+            'dp' computes the exact p-value of the 'mean' and 'sum' statistics (np.mean, np.sum) without
+            enumerating: their difference only depends on the sum of the lvl1 values, whose permutation
+            distribution is counted by dynamic programming over the integer scaled target (up to 6 decimals).
+            Feasible well beyond enumeration, e.g. for 50 vs 50 integer measurements; resampled_ and
+            resampled_diff are then None.
+        ranks : bool
+            Replace the target by its midranks over the 2 levels before testing. With func='mean' (or 'sum')
+            this is the Wilcoxon-Mann-Whitney rank-sum test, exact with exact='dp'. The default is False.
+        alpha : float, optional
+            Sequential Monte Carlo: R becomes the maximum number of resamples, drawn by streams of 250, and the
+            resampling stops as soon as the p-value is settled relative to alpha (its 3 sigma Wilson interval
+            excludes alpha). Clearly null tests stop after a few hundred resamples.
+        mc_tol : float, optional
+            Sequential Monte Carlo: stop once the Monte Carlo standard error of the p-value is at most mc_tol.
+            Either criterion stops the resampling when both alpha and mc_tol are set. The number of resamples
+            actually used is len(resampled_diff) and diagnostics_['R'].
+        summary : bool
+            Streaming reduction, with return_resampled=False and without alpha/mc_tol: the Monte Carlo resamples
+            are reduced as they are produced (by each worker) into a ResampledSummary, holding a running count of
+            the differences >= the observed one and a mergeable quantile sketch, returned in place of
+            resampled_diff. Memory then stays constant in R. Exact p-values are returned as usual.
+        adjust : str, optional
+            With a list of targets, 'maxT' returns the Westfall-Young step-down max-T adjusted p-values, which
+            control the family-wise error rate while accounting for the correlation between the targets:
+            computed from the same resamples of all the targets, each standardised by the mean and sd of its
+            resampled differences, without extra resampling. The unadjusted p-values are kept in
+            diagnostics_['pval_unadjusted']. The default None does not adjust.
 
         Returns
         -------
-         resampled_: PANDAS dataframe
-            DataFrame with first column being the 'levels' feature and the next R columns being the bootstrapped/permutated
-            resampled samples. This is a visual of how the resampling method redistributes the target
+         resampled_: PANDAS dataframe or None
+            DataFrame with first column being the 'levels' feature and the next R columns (one per split when the
+            splits are enumerated) being the bootstrapped/permutated resampled samples. This is a visual of how the resampling method redistributes the target
             values among the lvl1 and lvl2.Useful only for educational purposes to demonstrate the null hypothesis.
-         resampled_diff: PANDAS Series
-            Difference of bootstrapped/permutated statistic between the 2 levels selected.            
+            None when return_resampled is False. A dict of such dataframes by column for a list of targets.
+         resampled_diff: PANDAS Series or ResampledSummary or None
+            Difference of bootstrapped/permutated statistic between the 2 levels selected. None with exact='dp',
+            a ResampledSummary with summary=True. A DataFrame with one column per target for a list of targets.
         pval: numpy.float64
-            p-value of the statistical test.
+            p-value of the statistical test, the fraction of resampled differences >= the observed one (up to
+            a 1e-12 relative rounding tolerance, so tied resamples count). A Series by target for a list of
+            targets.
+
+        The number of resamples (or splits) used and the Monte Carlo standard error of the p-value, sqrt(p(1-p)/R)
+        (0 for exact p-values), are stored in the diagnostics_ dict of the instance, as 'R' and 'pval_se'.
+        """
+        x = _level_values(df, target, levels, lvl1)
+        y = _level_values(df, target, levels, lvl2)
+        if isinstance(df, PreparedData):
+            target, levels = df.target, df.levels
+        samples, resampled_diff, pval = self.run_hypothesis_arrays(
+            x, y, R, func, return_resampled=return_resampled, chunk_size=chunk_size, max_memory=max_memory,
+            engine=engine, exact=exact, ranks=ranks, alpha=alpha, mc_tol=mc_tol, summary=summary, adjust=adjust)
+        if isinstance(resampled_diff, np.ndarray):
+            index = range(1, resampled_diff.shape[0] + 1)
+            if isinstance(target, list):
+                resampled_diff = pd.DataFrame(resampled_diff, index=index, columns=target)
+                pval = pd.Series(pval, index=target)
+            else:
+                resampled_diff = pd.Series(resampled_diff, index=index)
+        if samples is None:
+            return None, resampled_diff, pval
+
+        # new dataframe to dump the resampled values, the lvl1 rows first
+        rows = np.repeat([lvl1, lvl2], [x.shape[0], y.shape[0]])
+        if isinstance(target, list):
+            resampled_ = {}
+            for j, column in enumerate(target):
+                resampled_[column] = pd.DataFrame(samples[:, :, j].T, columns=range(1, samples.shape[0] + 1))
+                resampled_[column].insert(0, levels, rows)
+            return resampled_, resampled_diff, pval
+        resampled_ = pd.DataFrame(samples.T, columns=range(1, samples.shape[0] + 1))
+        resampled_.insert(0, levels, rows)
+
+        return resampled_, resampled_diff, pval
+
+    def run_hypothesis_arrays(self, x, y, R, func, return_resampled=True, chunk_size=None, max_memory=None,
+                              engine='auto', exact='auto', ranks=False, alpha=None, mc_tol=None, summary=False,
+                              adjust=None):
         """
-        # reduce the dataframe to the features of interest
-        df = df[[levels, target]]
-        df = df[(df[levels] == lvl1) | (df[levels] == lvl2)]
-        df = df.reset_index()
+        run_hypothesis on NumPy arrays, without pandas: the lower level call behind it, for tight loops
+        over small samples.
+
+        Parameters
+        ----------
+        x : NumPy array
+            Target values at the first level (lvl1), (n1, k) for k targets.
+        y : NumPy array
+            Target values at the second level (lvl2), compared to x, (n2, k) for k targets.
+        R, func, return_resampled, chunk_size, max_memory, engine, exact, ranks, alpha, mc_tol, summary, adjust :
+            As in run_hypothesis.
 
-        x = df[df[levels] == lvl1][target]
-        y = df[df[levels] == lvl2][target]
+        Returns
+        -------
+        samples: NumPy array or None
+            (R, len(x)+len(y)) array of the resampled values, the x positions first, (R, n, k) for k targets.
+            None when return_resampled is False.
+        resampled_diff: NumPy array or ResampledSummary or None
+            Difference of bootstrapped/permutated statistic between x and y, as in run_hypothesis, (R, k) for k
+            targets.
+        pval: numpy.float64 or NumPy array
+            p-value of the statistical test, one per target for k targets.
+        """
+        n1 = len(x)
+        values = np.concatenate([np.asarray(x), np.asarray(y)])
+        if ranks:
+            values = _midranks(values)
+        mask1 = np.arange(values.shape[0]) < n1
+        mask2 = ~mask1
+        x, y = values[:n1], values[n1:]
         # observed difference of statistic
-        obs_diff_statistic = func(x)-func(y)
+        obs_diff_statistic = (_apply_statistic(func, x[None, :], axis=1)[0] -
+                              _apply_statistic(func, y[None, :], axis=1)[0])
 
-        resampled_ = df[[levels]]  # new dataframe to dump the resampled values
-        # Resampling block
+        # Resampling block: (chunk_size, n) index matrices gather the samples block by block,
+        # keeping only the resampled statistic unless resampled_ is requested
         if self.method == 'bootstrap':
-            for i in range(0, R):
-                b = df[target].sample(n=df.shape[0], replace=True)
-                b = b.reset_index(drop=True)
-                resampled_ = pd.concat(
-                    [resampled_, b], axis=1, ignore_index=True)
+            replace = True
         elif self.method == 'permutation':
-            for i in range(0, R):
-                b = df[target].sample(n=df.shape[0], replace=False)
-                b = b.reset_index(drop=True)
-                resampled_ = pd.concat(
-                    [resampled_, b], axis=1, ignore_index=True)
+            replace = False
         else:
             exit("Please set resampling method as 'bootstrap' or 'permutation' ")
+        chunk_size = _chunk_rows(values.shape[0], chunk_size, max_memory,
+                                 default=R if return_resampled else self._block_rows(values.shape[0]))
+        engine = self._resolve_engine(engine, func, values, replace, return_resampled)
 
         # calculate resampled statistic
-        resampled1 = resampled_[resampled_.loc[:, 0] == lvl1]
-        resampled2 = resampled_[resampled_.loc[:, 0] == lvl2]
-        f_resampled1 = resampled1.loc[:, 1:R].apply(func, axis=0)
-        f_resampled2 = resampled2.loc[:, 1:R].apply(func, axis=0)
+        if exact != 'auto' and exact != 'dp' and exact is not True and exact is not False:
+            exit("Please set exact as 'auto', 'dp', True or False")
+        if adjust is not None:
+            if adjust != 'maxT':
+                exit("Please set adjust as None or 'maxT'")
+            if values.ndim == 1:
+                exit("adjust='maxT' applies to a list of targets")
+            if summary:
+                exit("adjust='maxT' needs the resampled differences, not available with summary=True")
+        if exact == 'dp':
+            if values.ndim > 1:
+                exit("exact='dp' supports a single target only")
+            if replace:
+                exit("exact='dp' applies to the permutation method only")
+            if _statistic_spec(func) not in (('mean', None), ('sum', None)):
+                exit("exact='dp' supports only the 'mean' and 'sum' statistics")
+            pval = _subset_sum_pvalue(values, mask1)
+            if pval is None:
+                exit("exact='dp': the target cannot be scaled to small enough integers, use exact=True or False")
+            self.diagnostics_ = {'R': math.comb(values.shape[0], int(mask1.sum())), 'pval_se': 0.0}
+            return None, None, pval
+        if exact is True and replace:
+            exit('exact enumeration of the splits applies to the permutation method only')
+        # an empty level leaves a single split, nothing to enumerate: the Monte Carlo path runs as before
+        split = 0 < n1 < values.shape[0]
+        if exact is True and not split:
+            exit('exact enumeration of the splits needs values at both levels')
+        if exact is True or (exact == 'auto' and not replace and split and _comb_at_most(values.shape[0], n1, R)):
+            n_splits = math.comb(values.shape[0], n1)
+            if not return_resampled and values.ndim == 1 and _statistic_spec(func) in (('mean', None), ('sum', None)):
+                # sum-type statistics: splits enumerated in Gray code order with O(1) updates
+                diff, obs_diff_statistic, pval = _enumerated_sum_differences(values, mask1, func)
+                self.diagnostics_ = {'R': n_splits, 'pval_se': 0.0}
+                if diff is None:
+                    return None, None, pval
+                return None, diff, pval
+            # exact permutation distribution: every split once, in blocks of combinations
+            f_resampled, samples = _enumerated_statistics(values, mask1, func, chunk_size,
+                                                          keep_samples=return_resampled)
+            R = n_splits
+            exact = True
+        elif summary:
+            if return_resampled or alpha is not None or mc_tol is not None or values.ndim > 1:
+                exit('summary=True needs a single target and return_resampled=False, and cannot stop early with '
+                     'alpha or mc_tol')
+            # streaming reduction: exceedance counter and quantile sketch, merged across workers
+            resampled_diff, _ = self._resampled_statistics(values, [mask1, mask2], func, replace, R, chunk_size,
+                                                           engine=engine, summary=ResampledSummary(obs_diff_statistic),
+                                                           contrast=[1, -1])
+            pval = resampled_diff.pval
+            self.diagnostics_ = {'R': resampled_diff.n, 'pval_se': np.sqrt(pval*(1-pval)/resampled_diff.n)}
+            return None, resampled_diff, pval
+        else:
+            stop = None
+            threshold = _tie_threshold(obs_diff_statistic)
+            if alpha is not None or mc_tol is not None:
+                # sequential Monte Carlo: stop once the p-value is settled, from running counts
+                k, m = 0, 0
 
-        resampled_diff = f_resampled1-f_resampled2
+                def stop(stat):
+                    nonlocal k, m
+                    k = k + np.count_nonzero((stat[:, 0]-stat[:, 1]) >= threshold, axis=0)
+                    m += stat.shape[0]
+                    return all(_pvalue_settled(kj, m, alpha, mc_tol) for kj in np.atleast_1d(k))
+            f_resampled, samples = self._resampled_statistics(values, [mask1, mask2], func, replace, R, chunk_size,
+                                                              keep_samples=return_resampled, engine=engine, stop=stop)
+            R = f_resampled.shape[0]
+            exact = False
 
-        # calculate p-value
-        pval = np.sum((resampled_diff-obs_diff_statistic) >= 0)/R
+        resampled_diff = f_resampled[:, 0]-f_resampled[:, 1]
 
-        resampled_.rename(columns={0: levels}, inplace=True)
+        # calculate p-value: the resamples tied with the observed one count whatever the rounding of their statistic
+        pval = np.sum(resampled_diff >= _tie_threshold(obs_diff_statistic), axis=0)/R
+        if adjust == 'maxT':
+            # family-wise adjusted from the same resampled differences of all the targets
+            pval, pval_unadjusted = _maxt_adjusted(resampled_diff, obs_diff_statistic), pval
+        # its Monte Carlo standard error, none for the enumerated splits
+        self.diagnostics_ = {'R': R, 'pval_se': 0.0 if exact else np.sqrt(pval*(1-pval)/R)}
+        if adjust == 'maxT':
+            self.diagnostics_['pval_unadjusted'] = pval_unadjusted
 
-        return resampled_, resampled_diff, pval
+        return samples, resampled_diff, pval
 
-    def estimate_ci(self, df, target, levels, lvl, R, func, alpha_level=0.05):
+    def run_pairwise(self, df, target, levels, R, func, chunk_size=None, max_memory=None, engine='auto'):
         """
+        All the pairwise comparisons between the levels in one call: R resamples of the values of all the
+        levels are drawn once (bootstrap or permutation of the whole pool, as run_hypothesis does for the
+        2 levels it compares), the statistic of every level is computed once per resample and the
+        differences of every pair are taken by broadcasting.
+
         Parameters
         ----------
-        df : Pandas DataFrame
-            Dataframe contaning the data.
+        df : PANDAS dataframe or PreparedData
+            Entire dataset, or the dataset grouped by level with Resample.prepare.
+        target : str
+            Feature/column name that contains the data, a single column (not a list).
+        levels, R, func, chunk_size, max_memory :
+            As in run_hypothesis.
+        engine : str
+            As in run_hypothesis. With permutation and more than 2 levels only 'index' applies ('auto'
+            uses it).
+
+        Returns
+        -------
+        resampled_stat: PANDAS dataframe
+            Statistic of every level (columns) for each of the R resamples (rows).
+        pvals: PANDAS dataframe
+            p-value of each lvl1 (row) vs lvl2 (column) test, the fraction of resampled differences
+            >= the observed difference as in run_hypothesis; NaN on the diagonal.
+        """
+        if not isinstance(df, PreparedData):
+            df = PreparedData(df, target, levels)
+        elif (target is not None and target != df.target) or (levels is not None and levels != df.levels):
+            exit('target and levels must be None or match the prepared ones')
+        if self.method == 'bootstrap':
+            replace = True
+        elif self.method == 'permutation':
+            replace = False
+        else:
+            exit("Please set resampling method as 'bootstrap' or 'permutation' ")
+        values = df.values
+        if values.ndim > 1:
+            exit('run_pairwise compares a single target column, not a list of targets')
+        groups = [slice(start, stop) for start, stop in zip(df.bounds[:-1], df.bounds[1:])]
+        if not replace and len(groups) > 2:
+            # the counts engine splits the pool between 2 groups only
+            if engine == 'weights':
+                exit("engine='weights' compares 2 levels only with the permutation method")
+            engine = 'index'
+        chunk_size = _chunk_rows(values.shape[0], chunk_size, max_memory, default=self._block_rows(values.shape[0]))
+        engine = self._resolve_engine(engine, func, values, replace, False)
+
+        # observed statistic of every level and the differences of every pair
+        observed = np.array([_apply_statistic(func, values[g][None, :])[0] for g in groups])
+        obs_diff = observed[:, None] - observed[None, :]
+
+        stat, _ = self._resampled_statistics(values, groups, func, replace, R, chunk_size, engine=engine)
+        # p-values row by row, keeping the broadcast differences to (R, levels)
+        counts = np.array([np.count_nonzero((stat[:, [i]] - stat) >= _tie_threshold(obs_diff[i]), axis=0)
+                           for i in range(len(groups))])
+        pvals = counts / R
+        np.fill_diagonal(pvals, np.nan)
+        # Monte Carlo standard errors, as a matrix
+        self.diagnostics_ = {'R': R, 'pval_se': np.sqrt(pvals*(1-pvals)/R)}
+
+        resampled_stat = pd.DataFrame(stat, index=range(1, R + 1), columns=df.uniques)
+        pvals = pd.DataFrame(pvals, index=pd.Index(df.uniques, name=df.levels),
+                             columns=pd.Index(df.uniques, name=df.levels))
+        return resampled_stat, pvals
+
+    def estimate_ci(self, df, target, levels, lvl, R, func, alpha_level=0.05, chunk_size=None, max_memory=None,
+                    engine='auto', ci_tol=None, summary=False):
+        """
+        Parameters
+        ----------
+        df : Pandas DataFrame or PreparedData
+            Dataframe contaning the data, or the data grouped by level with Resample.prepare.
+        target : str or list
+            Feature/column name that contains the data. A list of columns bootstraps all of them with the same
+            resamples, see run_hypothesis; ci_tol then waits for the limits of every column.
         level : str/int/float
             One of the levels/categories of interest inside the levels feature.
         R : int
@@ -127,42 +1562,200 @@ class Resample():
             run_hypothesis(df,'target_feature','levels_feature',level_1,level_2,R=10000,func=my_func)
         OR:
             run_hypothesis(df,'target_feature','levels_feature',level_1,level_2,R=10000,func=np.mean)
+            As in run_hypothesis, axis-aware functions are evaluated over all the resamples in one call and
+            the named statistics ('mean', ('quantile', q), ...) are accepted.
 
         alpha_level : int
             Percentage (0,100)  for statistical confidence interval. The default is 5.
+        chunk_size : int, optional
+            Number of bootstrap samples generated and reduced per block. The default is 1000, or about 64k
+            values (2**16 // n samples of n values) with the threads backend. Results do not depend on the
+            block size.
+        max_memory : int, optional
+            Memory budget in bytes for a block of bootstrap samples, used to derive chunk_size instead.
+        engine : str
+            'auto' (default), 'index' or 'weights': multinomial counts over the unique values combined
+            with them by matrix products, for the built-in statistics only ('mean', 'sum', 'var', 'std',
+            'median', ('quantile', q), ('percentile', q), ('trimmed_mean', p)), see run_hypothesis.
+            'auto' picks 'weights' for these statistics when the target has at most n/2 distinct values,
+            e.g. np.mean on the Voltage of one Humidity level of test_data1 (5 distinct values in 10):
+            such calls draw other resamples than engine='index' for the same random_state.
+        ci_tol : float, optional
+            Adaptive R: R becomes the maximum number of bootstrap samples, drawn by streams of 250, and the
+            bootstrap stops once the batch-means standard errors of both interval endpoints (see ci_batch_se
+            below, robust to ties) are at most ci_tol, in the units of the statistic, after at least 10 streams.
+        summary : bool
+            Streaming reduction (without ci_tol): the bootstrapped statistics are reduced as they are produced
+            into a ResampledSummary, whose mergeable quantile sketch gives the interval, returned in place of
+            bootstrapped_stat. Memory then stays constant in R.
 
         Returns
         -------
-        bootstrapped_stat: PANDAS Series
+        bootstrapped_stat: PANDAS Series or ResampledSummary
             R statisticts estimated from each bootstrapped sample. Returned explicitly for post processing,
-            e.g. plot and confirm that central limit theorem kicked in.
+            e.g. plot and confirm that central limit theorem kicked in. A ResampledSummary with summary=True.
+            A DataFrame with one column per target for a list of targets.
         ci: tuple
-            confidence interval at the specified alpha level, upper and lower limits.
+            confidence interval at the specified alpha level, upper and lower limits. A dict of such tuples by
+            target for a list of targets.
+
+        The diagnostics_ dict of the instance holds, after each call:
+            'R': number of bootstrap samples used.
+            'ci_se': Monte Carlo standard errors of the (upper, lower) limits: the larger of the order statistics
+                estimate and ci_batch_se, as ties around a limit hide its variability from the order statistics.
+            'ci_batch_se': batch-means standard errors of the (upper, lower) limits: the limits computed in
+                every complete stream of 250 samples, std / sqrt(number of batches). Close to ci_se when the
+                limits are stable; NaN below 2 batches.
+            'ci_batches': the (upper, lower) limits of every batch, to check their drift.
+        With summary=True 'ci_se' is read from the quantile sketch and the batch diagnostics are not available.
+        For a list of targets every limit above is an array with one value per target.
 
         """
-        if self.method == 'bootstrap':
+        values = _level_values(df, target, levels, lvl)
+        if isinstance(df, PreparedData):
+            target = df.target
+        bootstrapped_stat, ci = self.estimate_ci_array(values, R, func, alpha_level=alpha_level, chunk_size=chunk_size,
+                                                       max_memory=max_memory, engine=engine, ci_tol=ci_tol,
+                                                       summary=summary)
+        if isinstance(target, list):
+            bootstrapped_stat = pd.DataFrame(bootstrapped_stat, index=range(1, bootstrapped_stat.shape[0] + 1),
+                                             columns=target)
+            ci = {column: (upper, lower) for column, upper, lower in zip(target, *ci)}
+        elif isinstance(bootstrapped_stat, np.ndarray):
+            # Series holding the per resample bootstrapped statistic
+            bootstrapped_stat = pd.Series(bootstrapped_stat, index=range(1, bootstrapped_stat.shape[0] + 1))
 
-            # reduce the dataframe to the features of interest at the level of interest
-            df = df[[levels, target]]
-            df = df[(df[levels] == lvl)]
-            df = df.reset_index()
+        return bootstrapped_stat, ci
+
+    def estimate_ci_all(self, df, target, levels, R, func, alpha_level=0.05, chunk_size=None, max_memory=None):
+        """
+        estimate_ci for every level in one pass: the bootstrap samples of all the levels, each drawn from
+        its own values, are gathered in the same index blocks over the values grouped by level (see
+        Resample.prepare) and reduced segment by segment ('mean' and 'sum' with np.add.reduceat).
 
-            # new dataframe to hold bootstrapped samples
-            df_ = df.drop(columns=[target])
+        Parameters
+        ----------
+        df : Pandas DataFrame or PreparedData
+            Dataframe contaning the data, or the data grouped by level with Resample.prepare.
+        target : str
+            Feature/column name that contains the data, a single column (not a list).
+        levels, R, func, alpha_level, max_memory :
+            As in estimate_ci.
+        chunk_size : int, optional
+            Number of bootstrap samples (of all the levels) generated and reduced per block. The default is
+            about 64k values, 2**16 // n samples of the n values of all the levels, at most 1000. Results do
+            not depend on the block size.
+
+        Returns
+        -------
+        bootstrapped_stat: PANDAS dataframe
+            Statistic of every level (columns) for each of the R bootstrap samples (rows).
+        cis: PANDAS dataframe
+            One row per level: the level, the observed 'statistic', 'ci_lower' and 'ci_upper' at the specified
+            alpha level and the number of values 'n'.
 
-            # bootstrapping block
-            for i in range(0, R):
-                b = df[target].sample(n=df.shape[0], replace=True)
-                b = b.reset_index(drop=True)
-                df_ = pd.concat([df_, b], axis=1, ignore_index=True)
+        The diagnostics_ dict of the instance holds 'R' and 'ci_se', the Monte Carlo standard errors of the
+        (upper, lower) limits of every level as a (levels, 2) array.
+        """
+        if self.method != 'bootstrap':
+            exit('confidence interval can be estimated only for bootstrap method')
+        if not isinstance(df, PreparedData):
+            df = PreparedData(df, target, levels)
+        elif (target is not None and target != df.target) or (levels is not None and levels != df.levels):
+            exit('target and levels must be None or match the prepared ones')
+        values = df.values
+        if values.ndim > 1:
+            exit('estimate_ci_all estimates a single target column, not a list of targets')
+        groups = [slice(start, stop) for start, stop in zip(df.bounds[:-1], df.bounds[1:])]
+        # blocks span all the levels: about 64k values keeps them in cache
+        chunk_size = _chunk_rows(values.shape[0], chunk_size, max_memory,
+                                 default=int(np.clip(_THREAD_BLOCK_VALUES // max(values.shape[0], 1), 1, _CHUNK_SIZE)))
+
+        observed = np.array([_apply_statistic(func, values[g][None, :])[0] for g in groups])
+        stat, _ = self._resampled_statistics(values, groups, func, True, R, chunk_size, engine='segments')
+
+        upper, lower = np.percentile(stat, q=[100-0.5*100*alpha_level, 0.5*100*alpha_level], axis=0)
+        self.diagnostics_ = {'R': R,
+                             'ci_se': np.array([np.column_stack(_ci_se(s, alpha_level, _batch_limits(s, alpha_level)))[0]
+                                                for s in stat.T])}
+
+        bootstrapped_stat = pd.DataFrame(stat, index=range(1, R + 1), columns=df.uniques)
+        cis = pd.DataFrame({df.levels: df.uniques, 'statistic': observed, 'ci_lower': lower, 'ci_upper': upper,
+                            'n': np.diff(df.bounds)})
+        return bootstrapped_stat, cis
+
+    def estimate_ci_array(self, x, R, func, alpha_level=0.05, chunk_size=None, max_memory=None, engine='auto',
+                          ci_tol=None, summary=False):
+        """
+        estimate_ci on a NumPy array, without pandas: the lower level call behind it, for tight loops
+        over small samples.
+
+        Parameters
+        ----------
+        x : NumPy array
+            Target values at the level of interest, (n, k) for k targets.
+        R, func, alpha_level, chunk_size, max_memory, engine, ci_tol, summary :
+            As in estimate_ci.
+
+        Returns
+        -------
+        bootstrapped_stat: NumPy array or ResampledSummary
+            R statistics estimated from each bootstrapped sample, as in estimate_ci, (R, k) for k targets.
+        ci: tuple
+            confidence interval at the specified alpha level, upper and lower limits (arrays for k targets).
+        """
+        if self.method == 'bootstrap':
+            # bootstrapping block: gather the samples with (chunk_size, n) index matrices
+            values = np.asarray(x)
+            chunk_size = _chunk_rows(values.shape[0], chunk_size, max_memory,
+                                     default=self._block_rows(values.shape[0]))
+            engine = self._resolve_engine(engine, func, values, True, False)
+            if summary:
+                if ci_tol is not None or values.ndim > 1:
+                    exit('summary=True needs a single target and cannot stop early with ci_tol')
+                # streaming reduction into a quantile sketch, merged across workers
+                bootstrapped_stat, _ = self._resampled_statistics(values, [slice(None)], func, True, R, chunk_size,
+                                                                  engine=engine, summary=ResampledSummary(),
+                                                                  contrast=[1])
+            else:
+                stop = None
+                if ci_tol is not None:
+                    # adaptive R: stop once both endpoints are precise enough
+                    batches = []
+
+                    def stop(stat):
+                        if stat.shape[0] == _STREAM_SIZE:
+                            batches.append(_batch_limits(stat[:, 0], alpha_level)[0])
+                        return _ci_settled(batches, alpha_level, ci_tol)
+                stat, _ = self._resampled_statistics(values, [slice(None)], func, True, R, chunk_size, engine=engine,
+                                                     stop=stop)
+                R = stat.shape[0]
         else:
             exit('confidence interval can be estimated only for bootstrap method')
 
-        # Series holding the per column bootstrapped statistic
-        bootstrapped_stat = df_.loc[:, 1:R].apply(func, axis=0)
+        if summary:
+            R = bootstrapped_stat.n
+            q = np.array([1-0.5*alpha_level, 0.5*alpha_level])
+            ci = tuple(bootstrapped_stat.quantile(q))
+            # order statistics one binomial standard deviation around the limits, read from the sketch
+            half = np.sqrt(q*(1-q)/R)
+            self.diagnostics_ = {'R': R,
+                                 'ci_se': tuple((bootstrapped_stat.quantile(np.minimum(q+half, 1)) -
+                                                 bootstrapped_stat.quantile(np.maximum(q-half, 0)))/2),
+                                 'ci_batch_se': (np.nan, np.nan),
+                                 'ci_batches': None}
+            return bootstrapped_stat, ci
+
+        bootstrapped_stat = stat[:, 0]
 
         # tuple holding the confidence interval
-        ci = (np.percentile(bootstrapped_stat, q=(100-0.5*100*alpha_level)),
-              np.percentile(bootstrapped_stat, q=0.5*100*alpha_level))
+        ci = (np.percentile(bootstrapped_stat, q=(100-0.5*100*alpha_level), axis=0),
+              np.percentile(bootstrapped_stat, q=0.5*100*alpha_level, axis=0))
+        # batch-means stability of the limits, one batch per stream: (batches, [targets,] 2) limits
+        batches = _batch_limits(bootstrapped_stat, alpha_level)
+        self.diagnostics_ = {'R': R,
+                             'ci_se': _ci_se(bootstrapped_stat, alpha_level, batches),
+                             'ci_batch_se': tuple(np.moveaxis(_batch_se(batches), -1, 0)),
+                             'ci_batches': batches}
 
         return bootstrapped_stat, ci
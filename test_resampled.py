@@ -0,0 +1,266 @@
+import itertools
+from fractions import Fraction
+
+import numpy as np
+import pandas as pd
+
+from resampled import _TIE_RATIO, _WEIGHTED_KERNELS, Resample, _kernel, _maxt_adjusted, _weighted_kernel
+
+
+def _tied_sample():
+    # 7 vs 6 values with 2 decimals: many splits have the same sum as the observed one
+    rng = np.random.default_rng(2)
+    return rng.normal(size=7).round(2), rng.normal(size=6).round(2)
+
+
+def _brute_force_pvalue(x, y, stat):
+    """ exact permutation p-value over all the splits, in rational arithmetic """
+    values = [Fraction(str(v)) for v in np.concatenate([x, y])]
+    n1 = len(x)
+    observed = stat(values[:n1]) - stat(values[n1:])
+    count = total = 0
+    for chosen in itertools.combinations(range(len(values)), n1):
+        rest = [values[i] for i in range(len(values)) if i not in chosen]
+        count += stat([values[i] for i in chosen]) - stat(rest) >= observed
+        total += 1
+    return count / total
+
+
+def _mean(values):
+    return sum(values) / len(values)
+
+
+def _median(values):
+    values = sorted(values)
+    m = len(values)
+    return (values[(m - 1) // 2] + values[m // 2]) / 2
+
+
+def test_enumerated_pvalue_counts_tied_splits():
+    x, y = _tied_sample()
+    expected = _brute_force_pvalue(x, y, _mean)
+    _, _, pval = Resample('permutation').run_hypothesis_arrays(x, y, R=10, func='mean', exact=True)
+    assert abs(pval - expected) < 1e-12
+
+
+def test_enumerated_pvalue_generic_statistic():
+    x, y = _tied_sample()
+    expected = _brute_force_pvalue(x, y, _median)
+    _, _, pval = Resample('permutation').run_hypothesis_arrays(x, y, R=10, func=np.median, exact=True,
+                                                               return_resampled=False)
+    assert abs(pval - expected) < 1e-12
+
+
+def test_exact_modes_agree_with_brute_force():
+    x, y = _tied_sample()
+    for func, stat in (('mean', _mean), ('sum', sum)):
+        expected = _brute_force_pvalue(x, y, stat)
+        for exact, return_resampled in ((True, True), (True, False), ('dp', False)):
+            _, _, pval = Resample('permutation').run_hypothesis_arrays(x, y, R=10, func=func, exact=exact,
+                                                                       return_resampled=return_resampled)
+            assert abs(pval - expected) < 1e-12, (func, exact, return_resampled)
+
+
+def test_gray_code_differences_match_combinations():
+    rng = np.random.default_rng(0)
+    x, y = rng.normal(size=6), rng.normal(size=5)
+    values = np.concatenate([x, y])
+    expected = sorted(values[list(c)].mean() - np.delete(values, c).mean()
+                      for c in itertools.combinations(range(values.shape[0]), x.shape[0]))
+    _, diff, pval = Resample('permutation').run_hypothesis_arrays(x, y, R=10, func='mean', exact=True,
+                                                                  return_resampled=False)
+    assert np.allclose(np.sort(diff), expected)
+    assert abs(pval - _brute_force_pvalue(x, y, _mean)) < 1e-12
+
+
+def test_streams_do_not_depend_on_n_jobs():
+    x, y = _tied_sample()
+    pvals = [Resample('permutation', random_state=0, n_jobs=n_jobs, backend='threads')
+             .run_hypothesis_arrays(x, y, R=1234, func='mean', exact=False, return_resampled=False)[2]
+             for n_jobs in (1, 3)]
+    assert pvals[0] == pvals[1]
+
+
+def test_unpicklable_statistic_runs_serially():
+    x, y = _tied_sample()
+    pvals = [Resample('permutation', random_state=0, n_jobs=n_jobs)
+             .run_hypothesis_arrays(x, y, R=600, func=lambda v: np.mean(v), exact=False, return_resampled=False)[2]
+             for n_jobs in (1, 2)]
+    assert pvals[0] == pvals[1]
+
+
+def test_chunk_size_does_not_change_results():
+    for seed in range(10):
+        rng = np.random.default_rng(seed)
+        x, y = rng.normal(size=9).round(1), rng.normal(size=7).round(1)
+        pvals = {Resample('permutation', random_state=seed)
+                 .run_hypothesis_arrays(x, y, R=2000, func='mean', engine='index', exact=False, chunk_size=chunk_size,
+                                        return_resampled=return_resampled)[2]
+                 for chunk_size in (None, 1, 7, 1000) for return_resampled in (False, True)}
+        assert len(pvals) == 1, seed
+
+
+def test_summary_does_not_depend_on_n_jobs():
+    x = np.random.default_rng(3).normal(size=40)
+    cis = [Resample('bootstrap', random_state=3, n_jobs=n_jobs, backend=backend)
+           .estimate_ci_array(x, R=5000, func='mean', summary=True)[1]
+           for n_jobs, backend in ((1, 'processes'), (2, 'processes'), (3, 'threads'))]
+    assert cis[0] == cis[1] == cis[2]
+
+
+def test_process_workers_return_the_resampled_values():
+    x, y = _tied_sample()
+    runs = [Resample('permutation', random_state=0, n_jobs=n_jobs)
+            .run_hypothesis_arrays(x, y, R=1234, func=np.median, exact=False, return_resampled=True)
+            for n_jobs in (1, 2)]
+    (samples1, diff1, pval1), (samples2, diff2, pval2) = runs
+    assert samples1.shape == (1234, 13)
+    assert np.array_equal(samples1, samples2) and np.array_equal(diff1, diff2) and pval1 == pval2
+
+
+def test_empty_level_is_not_enumerated():
+    x, _ = _tied_sample()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        _, _, pval = Resample('permutation', random_state=0).run_hypothesis_arrays(x, x[:0], R=100, func=np.mean)
+    assert pval == 0.0
+
+
+def _brute_force_maxt(resampled_diff, observed):
+    """ step-down max-T from its definition: max over the targets not more significant, then monotone """
+    t = (resampled_diff - resampled_diff.mean(axis=0)) / resampled_diff.std(axis=0)
+    t_obs = (observed - resampled_diff.mean(axis=0)) / resampled_diff.std(axis=0)
+    order = sorted(range(len(t_obs)), key=lambda j: -t_obs[j])
+    adjusted, running = {}, 0.0
+    for rank, j in enumerate(order):
+        rest = order[rank:]
+        running = max(running, np.mean([max(row[rest]) >= t_obs[j] for row in t]))
+        adjusted[j] = running
+    return np.array([adjusted[j] for j in range(len(t_obs))])
+
+
+def test_maxt_matches_brute_force():
+    rng = np.random.default_rng(4)
+    resampled_diff = rng.normal(size=(500, 4)) * [1, 2, 0.5, 1] + rng.normal(size=(500, 1))
+    observed = np.array([1.5, 1.0, 0.2, -0.5])
+    adjusted = _maxt_adjusted(resampled_diff, observed)
+    assert np.allclose(adjusted, _brute_force_maxt(resampled_diff, observed))
+    assert np.all(adjusted >= np.mean(resampled_diff >= observed, axis=0))
+    t_obs = (observed - resampled_diff.mean(axis=0)) / resampled_diff.std(axis=0)
+    assert np.all(np.diff(adjusted[np.argsort(-t_obs)]) >= 0)
+
+
+def test_maxt_list_target():
+    rng = np.random.default_rng(5)
+    df = pd.DataFrame({'a': rng.normal(size=24) + np.repeat([0.8, 0], 12), 'b': rng.normal(size=24),
+                       'c': rng.normal(size=24), 'level': np.repeat(['x', 'y'], 12)})
+    rs = Resample('permutation', random_state=0)
+    _, resampled_diff, pval = rs.run_hypothesis(df, ['a', 'b', 'c'], 'level', 'x', 'y', R=2000, func='mean',
+                                                exact=False, return_resampled=False, adjust='maxT')
+    assert isinstance(pval, pd.Series) and list(pval.index) == ['a', 'b', 'c']
+    assert list(resampled_diff.columns) == ['a', 'b', 'c']
+    unadjusted = rs.diagnostics_['pval_unadjusted']
+    observed = (df[df.level == 'x'][['a', 'b', 'c']].mean() - df[df.level == 'y'][['a', 'b', 'c']].mean()).to_numpy()
+    assert np.allclose(unadjusted, np.mean(resampled_diff.to_numpy() >= observed - 1e-9, axis=0))
+    assert np.all(pval.to_numpy() >= unadjusted)
+
+
+def test_weighted_kernels_match_index_kernels():
+    rng = np.random.default_rng(6)
+    v = np.sort(rng.normal(size=7).round(2))
+    m = 15
+    w = rng.multinomial(m, np.full(7, 1 / 7), size=50)
+    samples = np.stack([np.repeat(v, row) for row in w])
+    params = {'quantile': 0.3, 'percentile': 70, 'trimmed_mean': 0.2}
+    for name in _WEIGHTED_KERNELS:
+        func = (name, params[name]) if name in params else name
+        weighted = _weighted_kernel(func)(v, w.astype(float), m)
+        assert np.allclose(weighted, _kernel(func)(samples, axis=1)), name
+
+
+def test_auto_engine_uses_counts_only_for_tied_targets():
+    n = 20
+    at_ratio = np.arange(n) % int(_TIE_RATIO * n)
+    above_ratio = np.arange(n) % (int(_TIE_RATIO * n) + 1)
+    assert Resample._resolve_engine('auto', 'mean', at_ratio, True, False) == 'weights'
+    assert Resample._resolve_engine('auto', 'mean', above_ratio, True, False) == 'index'
+    # statistics without a count kernel, kept resamples and several targets stay on the index engine
+    assert Resample._resolve_engine('auto', lambda a: a.mean(), at_ratio, True, False) == 'index'
+    assert Resample._resolve_engine('auto', 'mean', at_ratio, True, True) == 'index'
+    assert Resample._resolve_engine('auto', 'mean', np.column_stack([at_ratio, at_ratio]), True, False) == 'index'
+
+
+def _levels_frame():
+    rng = np.random.default_rng(7)
+    return pd.DataFrame({'value': rng.normal(size=40).round(2), 'other': rng.normal(size=40).round(2),
+                         'level': rng.choice(['a', 'b', 'c', 'd'], size=40)})
+
+
+def test_prepared_data_matches_dataframe():
+    df = _levels_frame()
+    data = Resample.prepare(df, 'value', 'level')
+    for method in ('permutation', 'bootstrap'):
+        direct = Resample(method, random_state=0).run_hypothesis(df, 'value', 'level', 'a', 'c', R=1000, func='median',
+                                                                 exact=False)
+        prepared = Resample(method, random_state=0).run_hypothesis(data, None, None, 'a', 'c', R=1000, func='median',
+                                                                   exact=False)
+        assert direct[2] == prepared[2]
+        assert np.array_equal(direct[1], prepared[1])
+    direct = Resample('bootstrap', random_state=0).estimate_ci(df, 'value', 'level', 'b', R=1000, func='mean')
+    prepared = Resample('bootstrap', random_state=0).estimate_ci(data, None, None, 'b', R=1000, func='mean')
+    assert direct[1] == prepared[1]
+
+
+def test_pairwise_pvalues_match_their_resampled_statistics():
+    df = _levels_frame()
+    stat, pvals = Resample('permutation', random_state=0).run_pairwise(df, 'value', 'level', R=1000, func='mean')
+    observed = df.groupby('level')['value'].mean()
+    for a in pvals.index:
+        for b in pvals.columns:
+            if a == b:
+                assert np.isnan(pvals.loc[a, b])
+                continue
+            diff = (stat[a] - stat[b]).to_numpy()
+            assert pvals.loc[a, b] == np.mean(diff >= observed[a] - observed[b] - 1e-9), (a, b)
+
+
+def test_ci_all_matches_per_level_percentiles():
+    df = _levels_frame()
+    stat, cis = Resample('bootstrap', random_state=0).estimate_ci_all(df, 'value', 'level', R=1000, func='median')
+    assert list(cis['level']) == ['a', 'b', 'c', 'd']
+    for _, row in cis.iterrows():
+        values = df.value[df.level == row['level']]
+        assert row['statistic'] == np.median(values) and row['n'] == values.shape[0]
+        assert row['ci_upper'] == np.percentile(stat[row['level']], 97.5)
+        assert row['ci_lower'] == np.percentile(stat[row['level']], 2.5)
+
+
+def test_list_target_matches_single_targets():
+    df = _levels_frame()
+    for method in ('permutation', 'bootstrap'):
+        _, _, pval = Resample(method, random_state=0).run_hypothesis(df, ['value', 'other'], 'level', 'a', 'b', R=1000,
+                                                                     func='mean', exact=False)
+        for column in ('value', 'other'):
+            _, _, single = Resample(method, random_state=0).run_hypothesis(df, column, 'level', 'a', 'b', R=1000,
+                                                                           func='mean', engine='index', exact=False)
+            assert pval[column] == single, (method, column)
+
+
+def test_sequential_pvalue_stops_early_when_clearly_null():
+    x = np.random.default_rng(8).normal(size=30)
+    rs = Resample('permutation', random_state=0)
+    _, diff, pval = rs.run_hypothesis_arrays(x[:15], x[15:], R=100000, func='mean', exact=False, alpha=0.05,
+                                             return_resampled=False)
+    assert pval > 0.5
+    assert rs.diagnostics_['R'] == diff.shape[0] < 100000
+
+
+def test_ci_tol_raises_r_as_it_tightens():
+    x = np.random.default_rng(8).normal(size=30)
+    used = []
+    for ci_tol in (0.01, 0.005, 0.0025):
+        rs = Resample('bootstrap', random_state=0)
+        stat, _ = rs.estimate_ci_array(x, R=10 ** 6, func='mean', ci_tol=ci_tol)
+        assert rs.diagnostics_['R'] == stat.shape[0] < 10 ** 6
+        assert max(rs.diagnostics_['ci_batch_se']) <= ci_tol
+        used.append(rs.diagnostics_['R'])
+    assert used[0] < used[1] < used[2]